@@ -1,13 +1,21 @@
 import math
-from src.simulator import Simulator
-from skopt import gp_minimize
+from src.simulator import simulate, impulse_arrays, _simulate_batch_njit, GRAVITY, START_POSITION
+from src.optimizer import cook_cholesky_gp
+from skopt import Optimizer
 from skopt.space import Real
-from functools import partial
 import numpy as np
-import matplotlib.pyplot as plt
+import argparse
 import os
+import sys
+import hashlib
+import joblib
+import logging
+from logging.handlers import MemoryHandler
 
 # --- V2 Configuration ---
+# Order of the simulator's positional parameters.
+PARAM_NAMES = ('friction', 'elasticity', 'mass')
+
 GROUND_TRUTH_PARAMS = {
     'friction': 0.7,
     'elasticity': 0.9,
@@ -28,34 +36,176 @@ EXP_B_STEPS = 300
 EXP_C_IMPULSES = [(0, (8000, 8000)), (300, (25000, 0))]
 EXP_C_STEPS = 500
 
+# Number of candidates the optimizer proposes per iteration; each batch is
+# simulated in a single vectorized call.
+BATCH_SIZE = 8
+
+# Trajectories are oversampled (dt = 1/60 s) for a geometry-level error, so
+# the RMSE only compares every RMSE_STRIDE-th step.
+RMSE_STRIDE = 5
+
+# Stage A only searches masses whose closed-form peak height is within this
+# of the ground truth's.
+PEAK_TOLERANCE = 100.0
+
+# Stage C results are checkpointed here so repeat runs with the same
+# configuration can skip evaluations that were already made.
+CACHE_DIR = "cache"
+
+# Stage C's evaluation budget and initial design (seeds included in both),
+# and how many Stage A observations seed it besides the A/B best guess.
+STAGE_C_CALLS = 70
+STAGE_C_SEEDS = 5
+STAGE_C_INITIAL_POINTS = 16
 
 # --- Global state for tracking ---
 call_count = 0
 current_stage = ""
+logger = logging.getLogger(__name__)
+
+def stage_log_handler():
+    """
+    Returns the handler that holds per-guess log lines until the end of a
+    stage, installing it on first use.
+    """
+    for handler in logger.handlers:
+        if isinstance(handler, MemoryHandler):
+            return handler
+    handler = MemoryHandler(capacity=1000, flushLevel=logging.ERROR,
+                            target=logging.StreamHandler(sys.stdout))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return handler
 
-def calculate_rmse(t1, t2):
-    """Calculates the Root Mean Squared Error between two trajectories."""
-    t1, t2 = np.array(t1), np.array(t2)
-    return np.sqrt(np.mean((t1 - t2)**2))
+def calculate_rmse(t1, t2, stride=RMSE_STRIDE):
+    """
+    Calculates the Root Mean Squared Error between two (steps, 2) trajectory
+    arrays, sampling every stride-th step. The sum of squares is a single
+    BLAS dot product of the flattened difference.
+    """
+    d = np.subtract(t1[::stride], t2[::stride]).ravel()
+    return math.sqrt(d @ d / d.size)
 
-def objective_function(params, search_space_names, fixed_params, ground_truth_traj, steps, impulses):
-    """General objective function for our staged optimization."""
-    global call_count
-    call_count += 1
-    
-    # Combine the parameters being searched with the fixed ones
+def merge_params(params, search_space_names, fixed_params):
+    """Combines the parameters being searched with the fixed ones."""
     current_params = fixed_params.copy()
     for i, name in enumerate(search_space_names):
         current_params[name] = params[i]
-        
-    simulator = Simulator(params=current_params)
-    sim_trajectory = simulator.run_simulation_for_trajectory(steps=steps, impulses=impulses)
-    
-    rmse = calculate_rmse(ground_truth_traj, sim_trajectory)
-    
-    param_str = ", ".join([f"{k}={v:.2f}" for k, v in current_params.items()])
-    print(f"  {current_stage} Guess #{call_count}: ({param_str}) -> RMSE: {rmse:.2f}")
-    return rmse
+    return current_params
+
+def bounce_mass_bounds(impulses, gt_peak_y, low, high):
+    """
+    Closed-form bounds for the bounce experiment. Launched straight up from
+    rest, the ball's first apex is y0 + v0^2 / 2g with v0 = impulse_y / mass,
+    so the masses whose apex lands within PEAK_TOLERANCE of the ground-truth
+    peak form one interval. Returns it clipped to [low, high], or [low, high]
+    itself if the two do not overlap.
+    """
+    if len(impulses) != 1 or impulses[0][0] != 0 or impulses[0][1][0] != 0 or impulses[0][1][1] <= 0:
+        raise ValueError(f"bounce_mass_bounds needs a single upward impulse at step 0, got {impulses}")
+    impulse_y = impulses[0][1][1]
+
+    def mass_for_peak(peak_y):
+        rise = peak_y - START_POSITION[1]
+        return impulse_y / math.sqrt(2 * -GRAVITY * rise) if rise > 0 else math.inf
+
+    bounds = (max(low, mass_for_peak(gt_peak_y + PEAK_TOLERANCE)),
+              min(high, mass_for_peak(gt_peak_y - PEAK_TOLERANCE)))
+    if bounds[0] >= bounds[1]:
+        print(f"  Peak height {gt_peak_y:.1f} implies no mass in [{low}, {high}]; searching all of it")
+        return low, high
+    return bounds
+
+def make_batch_objective(search_space_names, fixed_params, ground_truth_traj, steps, impulses):
+    """
+    Builds the batch objective for one stage. The parameter layout, strided
+    ground truth and impulse arrays are prepared once and captured, so each
+    call only fills a (3, q) parameter array and runs the compiled simulator.
+    """
+    base = np.array([fixed_params.get(name, np.nan) for name in PARAM_NAMES])
+    search_rows = [PARAM_NAMES.index(name) for name in search_space_names]
+    gt_strided = np.ascontiguousarray(ground_truth_traj[::RMSE_STRIDE])
+    impulse_times, impulse_vecs = impulse_arrays(impulses)
+
+    def objective(xs):
+        params = np.repeat(base[:, None], len(xs), axis=1)
+        params[search_rows] = np.asarray(xs, dtype=np.float64).T
+        trajectories = _simulate_batch_njit(params[0], params[1], params[2], steps, impulse_times, impulse_vecs)
+        return [calculate_rmse(gt_strided, traj, stride=1) for traj in trajectories[:, ::RMSE_STRIDE]]
+
+    return objective
+
+def run_batched_minimize(search_space, search_space_names, fixed_params, ground_truth_traj, steps, impulses,
+                         n_calls, n_initial_points, prior_xs=None, prior_ys=None,
+                         acq_optimizer='auto', acq_optimizer_kwargs=None, base_estimator='GP'):
+    """
+    Batched replacement for gp_minimize. Each iteration asks the GP for
+    BATCH_SIZE points using the constant-liar strategy and simulates them
+    together in one vectorized sweep. Already-scored points can be passed as
+    prior_xs/prior_ys; n_calls counts only the new evaluations.
+    """
+    opt = Optimizer(dimensions=search_space, base_estimator=base_estimator, acq_func='LCB',
+                    n_initial_points=n_initial_points, random_state=42,
+                    acq_optimizer=acq_optimizer, acq_optimizer_kwargs=acq_optimizer_kwargs)
+    objective = make_batch_objective(search_space_names, fixed_params, ground_truth_traj, steps, impulses)
+
+    # The log format is built once per stage; the handler only formats the
+    # records when it flushes.
+    log_handler = stage_log_handler()
+    fixed_values = list(fixed_params.values())
+    log_fmt = ("  %s Guess #%d: ("
+               + ", ".join(f"{name}=%.2f" for name in [*fixed_params, *search_space_names])
+               + ") -> RMSE: %.2f")
+
+    def report(xs, ys):
+        global call_count
+        for x, rmse in zip(xs, ys):
+            call_count += 1
+            logger.info(log_fmt, current_stage, call_count, *fixed_values, *x, rmse)
+
+    if prior_xs:
+        opt.tell(prior_xs, prior_ys)
+    n_prior = len(opt.yi)
+
+    while len(opt.yi) - n_prior < n_calls:
+        n_remaining = n_calls - (len(opt.yi) - n_prior)
+        xs = opt.ask(n_points=min(BATCH_SIZE, n_remaining), strategy='cl_min')
+        ys = objective(xs)
+        opt.tell(xs, ys)
+        report(xs, ys)
+
+    # Write the whole stage's log in one go
+    log_handler.flush()
+    return opt.get_result()
+
+def _run_stage(stage_name, search_space, fixed_params, ground_truth_traj, steps, impulses,
+               n_calls, n_initial_points):
+    """
+    Runs one optimization stage over the named dimensions of search_space.
+    """
+    global call_count, current_stage
+    current_stage = stage_name
+    call_count = 0
+    return run_batched_minimize(search_space,
+                                search_space_names=[dim.name for dim in search_space],
+                                fixed_params=fixed_params,
+                                ground_truth_traj=ground_truth_traj, steps=steps, impulses=impulses,
+                                n_calls=n_calls, n_initial_points=n_initial_points)
+
+def stage_c_checkpoint_path(prior_xs, search_space, ground_truth_traj):
+    """
+    Checkpoint file for Stage C, keyed by a hash of what the run actually
+    starts from: its seed points, search bounds and target trajectory. Any
+    change upstream (Stage A/B settings, batch size, simulator) changes the
+    seeds or the target, and so the key.
+    """
+    digest = hashlib.sha1()
+    digest.update(np.asarray(prior_xs, dtype=np.float64).tobytes())
+    digest.update(repr([(dim.name, dim.bounds) for dim in search_space]).encode())
+    digest.update(np.ascontiguousarray(ground_truth_traj).tobytes())
+    digest.update(repr((EXP_C_STEPS, EXP_C_IMPULSES, RMSE_STRIDE)).encode())
+    return os.path.join(CACHE_DIR, f"stage_c_{digest.hexdigest()[:12]}.pkl")
 
 def plot_results(ground_truth_traj, initial_guess_params, final_params, impulses, steps, filename):
     """
@@ -63,24 +213,25 @@ def plot_results(ground_truth_traj, initial_guess_params, final_params, impulses
     and final calibrated trajectories.
     """
     print(f"\n--- Generating final plot... ---")
+
+    # Imported here so runs without --plot skip matplotlib's start-up cost;
+    # Agg avoids probing for a display on headless machines.
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
     
     # Get the trajectory for the initial incorrect guess
-    initial_sim = Simulator(params=initial_guess_params)
-    initial_traj = initial_sim.run_simulation_for_trajectory(steps=steps, impulses=impulses)
+    initial_traj = simulate(initial_guess_params, steps, impulses)
 
     # Get the trajectory for the final calibrated parameters
-    final_sim = Simulator(params=final_params)
-    final_traj = final_sim.run_simulation_for_trajectory(steps=steps, impulses=impulses)
+    final_traj = simulate(final_params, steps, impulses)
 
-    # Unzip trajectories for plotting
-    gt_x, gt_y = zip(*ground_truth_traj)
-    initial_x, initial_y = zip(*initial_traj)
-    final_x, final_y = zip(*final_traj)
+    ground_truth_traj = np.asarray(ground_truth_traj)
 
     plt.figure(figsize=(12, 8))
-    plt.plot(gt_x, gt_y, 'g-', label='Ground Truth Trajectory', linewidth=4, alpha=0.8)
-    plt.plot(initial_x, initial_y, 'r--', label='Initial Guess Trajectory', linewidth=2)
-    plt.plot(final_x, final_y, 'b:', label='Calibrated Trajectory', linewidth=2, alpha=0.9)
+    plt.plot(ground_truth_traj[:, 0], ground_truth_traj[:, 1], 'g-', label='Ground Truth Trajectory', linewidth=4, alpha=0.8)
+    plt.plot(initial_traj[:, 0], initial_traj[:, 1], 'r--', label='Initial Guess Trajectory', linewidth=2)
+    plt.plot(final_traj[:, 0], final_traj[:, 1], 'b:', label='Calibrated Trajectory', linewidth=2, alpha=0.9)
     
     plt.title('Causal Oracle Calibration Results', fontsize=16)
     plt.xlabel('X Position', fontsize=12)
@@ -95,52 +246,46 @@ def plot_results(ground_truth_traj, initial_guess_params, final_params, impulses
     print(f"Plot saved successfully to {filename}")
 
 
-def run_staged_calibration():
+def run_staged_calibration(plot=False):
     """
     Runs the entire V2 experiment using the definitive staged approach.
+    The comparison plot is only generated when plot is True.
     """
     initial_guess = {'friction': 0.5, 'elasticity': 0.5, 'mass': 15.0} # Start with a neutral guess
     best_params = initial_guess.copy()
     global call_count, current_stage
 
     # === STAGE A: OPTIMIZE ELASTICITY & MASS ===
-    current_stage = "Stage A (Bounce)"
-    call_count = 0
-    print(f"\n--- {current_stage}: Isolating Elasticity and Mass ---")
-    
-    sim_a = Simulator(GROUND_TRUTH_PARAMS)
-    traj_a = sim_a.run_simulation_for_trajectory(steps=EXP_A_STEPS, impulses=EXP_A_IMPULSES)
-    
-    search_space_a = [Real(0.1, 1.0, name='elasticity'), Real(5.0, 25.0, name='mass')]
-    
-    obj_a = partial(objective_function, 
-                    search_space_names=['elasticity', 'mass'],
-                    fixed_params={'friction': best_params['friction']},
-                    ground_truth_traj=traj_a, steps=EXP_A_STEPS, impulses=EXP_A_IMPULSES)
+    print("\n--- Stage A (Bounce): Isolating Elasticity and Mass ---")
+
+    traj_a = simulate(GROUND_TRUTH_PARAMS, EXP_A_STEPS, EXP_A_IMPULSES)
+
+    # Stage A's first apex has a closed form, so masses that cannot reach the
+    # observed peak are left out of its search space instead of being
+    # simulated. Stage B has no equivalent: the ball lands mid-slide and
+    # rolls, so its travel is not a simple friction formula.
+    mass_bounds_a = bounce_mass_bounds(EXP_A_IMPULSES, traj_a[:, 1].max(), 5.0, 25.0)
+    search_space_a = [Real(0.1, 1.0, name='elasticity'), Real(*mass_bounds_a, name='mass')]
+    fixed_a = {'friction': best_params['friction']}
+    result_a = _run_stage("Stage A (Bounce)", search_space_a, fixed_a,
+                          traj_a, EXP_A_STEPS, EXP_A_IMPULSES, n_calls=50, n_initial_points=25)
 
-    result_a = gp_minimize(func=obj_a, dimensions=search_space_a, n_calls=50, n_initial_points=25, random_state=42, verbose=False)
-    
     best_params['elasticity'] = result_a.x[0]
     best_params['mass'] = result_a.x[1]
     print(f"--- Stage A Complete. Best found: e={best_params['elasticity']:.4f}, m={best_params['mass']:.4f} ---")
 
     # === STAGE B: OPTIMIZE FRICTION ===
-    current_stage = "Stage B (Slide)"
-    call_count = 0
-    print(f"\n--- {current_stage}: Isolating Friction ---")
+    # Stage B needs Stage A's mass: with the initial guess's mass its RMSE
+    # only rises with friction, and the search ends on its lower bound.
+    print("\n--- Stage B (Slide): Isolating Friction ---")
+
+    traj_b = simulate(GROUND_TRUTH_PARAMS, EXP_B_STEPS, EXP_B_IMPULSES)
 
-    sim_b = Simulator(GROUND_TRUTH_PARAMS)
-    traj_b = sim_b.run_simulation_for_trajectory(steps=EXP_B_STEPS, impulses=EXP_B_IMPULSES)
-    
     search_space_b = [Real(0.1, 1.0, name='friction')]
-    
-    obj_b = partial(objective_function, 
-                    search_space_names=['friction'],
-                    fixed_params={'elasticity': best_params['elasticity'], 'mass': best_params['mass']},
-                    ground_truth_traj=traj_b, steps=EXP_B_STEPS, impulses=EXP_B_IMPULSES)
+    fixed_b = {'elasticity': best_params['elasticity'], 'mass': best_params['mass']}
+    result_b = _run_stage("Stage B (Slide)", search_space_b, fixed_b,
+                          traj_b, EXP_B_STEPS, EXP_B_IMPULSES, n_calls=30, n_initial_points=15)
 
-    result_b = gp_minimize(func=obj_b, dimensions=search_space_b, n_calls=30, n_initial_points=15, random_state=42, verbose=False)
-    
     best_params['friction'] = result_b.x[0]
     print(f"--- Stage B Complete. Best found: f={best_params['friction']:.4f} ---")
 
@@ -149,17 +294,54 @@ def run_staged_calibration():
     call_count = 0
     print(f"\n--- {current_stage}: Final Refinement of All Parameters ---")
 
-    sim_c = Simulator(GROUND_TRUTH_PARAMS)
-    traj_c = sim_c.run_simulation_for_trajectory(steps=EXP_C_STEPS, impulses=EXP_C_IMPULSES)
+    traj_c = simulate(GROUND_TRUTH_PARAMS, EXP_C_STEPS, EXP_C_IMPULSES)
     
     search_space_c = [Real(0.1, 1.0, name='friction'), Real(0.1, 1.0, name='elasticity'), Real(5.0, 25.0, name='mass')]
-    
-    obj_c = partial(objective_function, 
-                    search_space_names=['friction', 'elasticity', 'mass'],
-                    fixed_params={},
-                    ground_truth_traj=traj_c, steps=EXP_C_STEPS, impulses=EXP_C_IMPULSES)
+    names_c = ['friction', 'elasticity', 'mass']
+
+    # Seed the GP with the combined A/B best guess plus the Stage A
+    # observations that score best on this experiment, all with Stage B's
+    # friction: raw A/B points carry frictions that can offset a small mass
+    # error and displace Stage B's estimate. Each extra seed makes every
+    # constant-liar refit in ask() dearer. The best guess goes first because
+    # skopt reports the first of tied minima, and Stage C's RMSE is flat in
+    # friction above ~0.3.
+    fixed_c = {'friction': best_params['friction']}
+    observed_xs = [[merge_params(x, ['elasticity', 'mass'], fixed_c)[n] for n in names_c]
+                   for x in result_a.x_iters]
+    objective_c = make_batch_objective(names_c, {}, traj_c, EXP_C_STEPS, EXP_C_IMPULSES)
+    observed_ys = objective_c(observed_xs)
+    prior_xs = [[best_params[n] for n in names_c]]
+    prior_xs += [observed_xs[i] for i in np.argsort(observed_ys, kind='stable')[:STAGE_C_SEEDS]]
+
+    # A previous run from the same seeds already holds their scores plus its
+    # own evaluations, so resume from it and only make up any shortfall.
+    ckpt = stage_c_checkpoint_path(prior_xs, search_space_c, traj_c)
+    prior = joblib.load(ckpt) if os.path.exists(ckpt) else None
+    if prior is not None and np.array_equal(prior['x_iters'][:len(prior_xs)], prior_xs):
+        prior_xs, prior_ys = prior['x_iters'], prior['func_vals']
+        print(f"  Resuming from {len(prior_xs)} checkpointed points in {ckpt}")
+    else:
+        prior_ys = objective_c(prior_xs)
+        print(f"  Seeded with {len(prior_xs)} points from Stages A and B")
+    n_calls_c = max(0, STAGE_C_CALLS - len(prior_xs))
+
+    # Multi-start L-BFGS on the acquisition function gets expensive as the
+    # observations grow; maximize it over 10000 random samples instead, with
+    # the GP's predictive variance computed from the inverse Cholesky factor.
+    result_c = run_batched_minimize(search_space_c,
+                                    search_space_names=names_c,
+                                    fixed_params={},
+                                    ground_truth_traj=traj_c, steps=EXP_C_STEPS, impulses=EXP_C_IMPULSES,
+                                    n_calls=n_calls_c, n_initial_points=STAGE_C_INITIAL_POINTS,
+                                    prior_xs=prior_xs, prior_ys=prior_ys,
+                                    acq_optimizer='sampling', acq_optimizer_kwargs={'n_points': 10000},
+                                    base_estimator=cook_cholesky_gp(search_space_c, random_state=42))
 
-    result_c = gp_minimize(func=obj_c, dimensions=search_space_c, n_calls=70, x0=list(best_params.values()), n_initial_points=35, random_state=42, verbose=False)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Resuming only needs the observations, not the fitted GPs in result_c.models.
+    joblib.dump({'x_iters': [[float(v) for v in x] for x in result_c.x_iters],
+                 'func_vals': [float(y) for y in result_c.func_vals]}, ckpt)
     
     final_params = {
         'friction': result_c.x[0],
@@ -178,16 +360,21 @@ def run_staged_calibration():
     print("-----------------------------------------------")
 
     # --- Generate Final Plot ---
-    plot_results(
-        ground_truth_traj=traj_c,
-        initial_guess_params=initial_guess,
-        final_params=final_params,
-        impulses=EXP_C_IMPULSES,
-        steps=EXP_C_STEPS,
-        filename="paper/figures/trajectory_comparison.png"
-    )
+    if plot:
+        plot_results(
+            ground_truth_traj=traj_c,
+            initial_guess_params=initial_guess,
+            final_params=final_params,
+            impulses=EXP_C_IMPULSES,
+            steps=EXP_C_STEPS,
+            filename="paper/figures/trajectory_comparison.png"
+        )
 
 
 if __name__ == "__main__":
-    run_staged_calibration()
+    parser = argparse.ArgumentParser(description="Run the staged Causal Oracle calibration.")
+    parser.add_argument('--plot', action='store_true',
+                        help="save the trajectory comparison plot to paper/figures")
+    args = parser.parse_args()
+    run_staged_calibration(plot=args.plot)
 
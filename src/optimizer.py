@@ -1,9 +1,59 @@
 import numpy as np
 from skopt import gp_minimize
+from skopt.learning import GaussianProcessRegressor
 from skopt.space import Real
+from skopt.utils import cook_estimator
+from sklearn.utils import check_array
+from scipy.linalg import solve_triangular
 from functools import partial
 from src.simulator import Simulator
 
+
+class CholeskyGaussianProcessRegressor(GaussianProcessRegressor):
+    """
+    skopt's GP regressor with the predictive variance computed from the
+    inverse Cholesky factor.
+
+    Acquisition maximization predicts at thousands of candidate points per
+    iteration. skopt computes the variance as k** - k K_inv k with a
+    three-operand einsum, which does not use BLAS and costs more than the
+    kernel evaluation itself. Here it is ||L^-1 k||^2: one matrix product and
+    a row-wise sum of squares, equal to skopt's result to round-off. The
+    inverse factor is built once per fit. Covariance and gradient requests
+    use the parent implementation.
+    """
+    def fit(self, X, y):
+        super().fit(X, y)
+        self.L_inv_ = solve_triangular(self.L_, np.eye(self.L_.shape[0]), lower=True)
+        return self
+
+    def predict(self, X, return_std=False, return_cov=False,
+                return_mean_grad=False, return_std_grad=False):
+        if return_cov or return_mean_grad or return_std_grad:
+            return super().predict(X, return_std=return_std, return_cov=return_cov,
+                                   return_mean_grad=return_mean_grad,
+                                   return_std_grad=return_std_grad)
+
+        X = check_array(X)
+        K_trans = self.kernel_(X, self.X_train_)
+        # undo normalisation
+        y_mean = self.y_train_std_ * K_trans.dot(self.alpha_) + self.y_train_mean_
+        if not return_std:
+            return y_mean
+
+        v = K_trans @ self.L_inv_.T
+        y_var = self.kernel_.diag(X) - np.einsum("ki,ki->k", v, v)
+        # round-off can push tiny variances below zero
+        y_var = np.maximum(y_var, 0.0) * self.y_train_std_**2
+        return y_mean, np.sqrt(y_var)
+
+
+def cook_cholesky_gp(space, random_state=None):
+    """Builds the same GP skopt uses for base_estimator="GP", with the faster variance."""
+    gp = cook_estimator("GP", space=space, random_state=random_state)
+    return CholeskyGaussianProcessRegressor(**gp.get_params(deep=False))
+
+
 class BayesianOptimizer:
     """
     Handles the optimization process by wrapping the robust skopt.gp_minimize function.
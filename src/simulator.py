@@ -1,55 +1,235 @@
 import pymunk
 import numpy as np
+from math import cos, sin, sqrt
+from numba import njit
+
+# --- Scene definition (shared by the Pymunk scene and the compiled surrogate) ---
+GRAVITY = -1000.0
+DT = 1 / 60.0
+START_POSITION = (0.0, 300.0)
+BALL_RADIUS = 20.0
+FLOOR_Y = 50.0
+FLOOR_HALF_LENGTH = 5000.0
+FLOOR_RADIUS = 5.0
+FLOOR_FRICTION = 1.0
+# The floor never sets an elasticity, so it keeps Pymunk's default of 0.
+FLOOR_ELASTICITY = 0.0
+
+# Chipmunk solver defaults, needed to reproduce its contact response.
+COLLISION_SLOP = 0.1
+COLLISION_BIAS = (1 - 0.1) ** 60
+
+
+@njit(cache=True, fastmath=True)
+def _simulate_batch_njit(friction, elasticity, mass, steps, impulse_times, impulse_vecs):
+    """
+    Compiled surrogate for the Pymunk scene: one solid disk against the floor
+    segment. Follows Chipmunk's step order (integrate positions, detect the
+    contact, integrate velocities, solve the contact impulses) including
+    rolling friction and the floor's rounded ends. Impulses are given in the
+    body's local frame, like apply_impulse_at_local_point, so they rotate with
+    the ball. impulse_times must be sorted.
+
+    Advances one independent ball per entry of the (q,) parameter arrays in
+    lockstep, with the state held as (q,) arrays, and returns (q, steps, 2).
+    """
+    q = friction.shape[0]
+    traj = np.empty((q, steps, 2))
+    inv_mass = 1.0 / mass
+    inertia = 0.5 * mass * BALL_RADIUS * BALL_RADIUS
+    k_t = inv_mass + BALL_RADIUS * BALL_RADIUS / inertia
+    mu = friction * FLOOR_FRICTION
+    restitution = elasticity * FLOOR_ELASTICITY
+    bias_coef = 1.0 - COLLISION_BIAS ** DT
+    r_sum = BALL_RADIUS + FLOOR_RADIUS
+
+    x = np.full(q, START_POSITION[0])
+    y = np.full(q, START_POSITION[1])
+    vx = np.zeros(q)
+    vy = np.zeros(q)
+    angle = np.zeros(q)
+    w = np.zeros(q)
+    bias_vx = np.zeros(q)
+    bias_vy = np.zeros(q)
+    k = 0
+    for i in range(steps):
+        # Apply any scheduled impulses to the center of each body
+        while k < impulse_times.shape[0] and impulse_times[k] == i:
+            ix = impulse_vecs[k, 0]
+            iy = impulse_vecs[k, 1]
+            for j in range(q):
+                c = cos(angle[j])
+                s = sin(angle[j])
+                vx[j] += (c * ix - s * iy) * inv_mass[j]
+                vy[j] += (s * ix + c * iy) * inv_mass[j]
+            k += 1
+
+        for j in range(q):
+            x[j] += (vx[j] + bias_vx[j]) * DT
+            y[j] += (vy[j] + bias_vy[j]) * DT
+            angle[j] += w[j] * DT
+            bias_vx[j] = 0.0
+            bias_vy[j] = 0.0
+
+            # Contact against the closest point of the floor segment
+            dx = x[j] - min(max(x[j], -FLOOR_HALF_LENGTH), FLOOR_HALF_LENGTH)
+            dy = y[j] - FLOOR_Y
+            dist = sqrt(dx * dx + dy * dy)
+            touching = dist < r_sum
+            nx = 0.0
+            ny = 1.0
+            bounce = 0.0
+            bias = 0.0
+            if touching:
+                if dist > 0.0:
+                    nx = dx / dist
+                    ny = dy / dist
+                bounce = restitution[j] * (vx[j] * nx + vy[j] * ny)
+                bias = -bias_coef * min(0.0, dist - r_sum + COLLISION_SLOP) / DT
+
+            vy[j] += GRAVITY * DT
+
+            if touching:
+                jn = max(-(bounce + vx[j] * nx + vy[j] * ny) * mass[j], 0.0)
+                vx[j] += nx * jn * inv_mass[j]
+                vy[j] += ny * jn * inv_mass[j]
+
+                # Coulomb friction at the contact point, which also spins the ball
+                tx = -ny
+                ty = nx
+                vt = vx[j] * tx + vy[j] * ty - w[j] * BALL_RADIUS
+                jt_max = mu[j] * jn
+                jt = min(max(-vt / k_t[j], -jt_max), jt_max)
+                vx[j] += tx * jt * inv_mass[j]
+                vy[j] += ty * jt * inv_mass[j]
+                w[j] -= jt * BALL_RADIUS / inertia[j]
+
+                bias_vx[j] = nx * bias
+                bias_vy[j] = ny * bias
+
+            traj[j, i, 0] = x[j]
+            traj[j, i, 1] = y[j]
+
+    return traj
+
+
+@njit(cache=True)
+def _simulate_njit(friction, elasticity, mass, steps, impulse_times, impulse_vecs):
+    """Single-ball version of _simulate_batch_njit, returning (steps, 2)."""
+    return _simulate_batch_njit(np.array([friction]), np.array([elasticity]), np.array([mass]),
+                                steps, impulse_times, impulse_vecs)[0]
+
+
+def _build_impulse_map(impulses):
+    """Indexes an impulse schedule by step, summing impulses that share a step."""
+    impulse_map = {}
+    for t_impulse, (ix, iy) in impulses:
+        px, py = impulse_map.get(t_impulse, (0.0, 0.0))
+        impulse_map[t_impulse] = (px + ix, py + iy)
+    return impulse_map
+
+
+def _impulse_arrays(impulse_map):
+    """Converts an impulse map into the sorted (times, vectors) arrays the kernels expect."""
+    impulse_times = np.array(sorted(impulse_map), dtype=np.int64)
+    impulse_vecs = np.array([impulse_map[t] for t in impulse_times], dtype=np.float64).reshape(-1, 2)
+    return impulse_times, impulse_vecs
+
+
+def impulse_arrays(impulses):
+    """Converts an impulse schedule into the arrays the compiled kernels take."""
+    return _impulse_arrays(_build_impulse_map(impulses))
+
+
+def simulate_batch(friction, elasticity, mass, steps, impulses):
+    """
+    Simulates one ball per entry of the friction/elasticity/mass arrays and
+    returns their trajectories as a (q, steps, 2) array.
+    """
+    impulse_times, impulse_vecs = impulse_arrays(impulses)
+    return _simulate_batch_njit(np.asarray(friction, dtype=np.float64),
+                                np.asarray(elasticity, dtype=np.float64),
+                                np.asarray(mass, dtype=np.float64),
+                                steps, impulse_times, impulse_vecs)
+
 
 class Simulator:
     """
     A simple 2D physics simulator using Pymunk.
     THIS VERSION CONTAINS THE CRITICAL BUG FIX.
+
+    Trajectories come from the compiled surrogate (_simulate_njit); the Pymunk
+    space is kept as the reference implementation (run_pymunk_trajectory).
     """
-    def __init__(self, params=None):
+    def __init__(self, params=None, impulses=None):
         if params is None:
             params = {}
 
         self.space = pymunk.Space()
-        self.space.gravity = (0, -1000)
+        self.space.gravity = (0, GRAVITY)
 
         # Create floor
         floor_body = self.space.static_body
-        floor_shape = pymunk.Segment(floor_body, (-5000, 50), (5000, 50), 5)
-        floor_shape.friction = 1.0
+        floor_shape = pymunk.Segment(floor_body, (-FLOOR_HALF_LENGTH, FLOOR_Y), (FLOOR_HALF_LENGTH, FLOOR_Y), FLOOR_RADIUS)
+        floor_shape.friction = FLOOR_FRICTION
         self.space.add(floor_shape)
 
         # Create the dynamic object
         mass = params.get('mass', 10.0)
-        moment = pymunk.moment_for_circle(mass, 0, 20)
+        moment = pymunk.moment_for_circle(mass, 0, BALL_RADIUS)
         body = pymunk.Body(mass, moment)
-        body.position = (0, 300)
+        body.position = START_POSITION
 
-        shape = pymunk.Circle(body, 20)
+        shape = pymunk.Circle(body, BALL_RADIUS)
         shape.elasticity = params.get('elasticity', 0.95)
         shape.friction = params.get('friction', 0.7)
-        
+
         # *** THE CRITICAL BUG FIX IS HERE ***
         # We must add both the body and the shape to the space.
         self.space.add(body, shape)
 
         self.body = body
+        self.shape = shape
+        self._impulse_map = _build_impulse_map(impulses or [])
 
-    def run_simulation_for_trajectory(self, steps, impulses):
+    def run_simulation_for_trajectory(self, steps, impulses=None):
         """
         Runs the simulation for a given number of steps, applying impulses at
-        specific times, and returns the full trajectory.
+        specific times, and returns the full trajectory as a (steps, 2) array.
+        If no impulses are given, the schedule passed to __init__ is used.
         """
-        trajectory = []
-        for step in range(steps):
-            # Apply any scheduled impulses
-            for t_impulse, impulse_vector in impulses:
-                if step == t_impulse:
-                    # Apply impulse to the center of the body
-                    self.body.apply_impulse_at_local_point(impulse_vector)
+        imp = self._impulse_map if impulses is None else _build_impulse_map(impulses)
+        impulse_times, impulse_vecs = _impulse_arrays(imp)
+
+        return _simulate_njit(self.shape.friction, self.shape.elasticity, self.body.mass,
+                              steps, impulse_times, impulse_vecs)
+
+    def run_pymunk_trajectory(self, steps, impulses=None):
+        """
+        Reference version of run_simulation_for_trajectory that steps the
+        Pymunk space. Used to validate the compiled surrogate.
+        """
+        imp = self._impulse_map if impulses is None else _build_impulse_map(impulses)
+        traj = np.empty((steps, 2), dtype=np.float64)
+        body = self.body
+        step_fn = self.space.step
+
+        for i in range(steps):
+            # Apply any scheduled impulse to the center of the body
+            iv = imp.get(i)
+            if iv is not None:
+                body.apply_impulse_at_local_point(iv)
+
+            step_fn(DT)
+            p = body.position
+            traj[i, 0] = p.x
+            traj[i, 1] = p.y
 
-            self.space.step(1 / 60.0)
-            trajectory.append(self.body.position)
+        return traj
 
-        return trajectory
 
+def simulate(params, steps, impulses):
+    """Returns the trajectory for a parameter dict and experiment."""
+    impulse_times, impulse_vecs = impulse_arrays(impulses)
+    return _simulate_njit(float(params['friction']), float(params['elasticity']), float(params['mass']),
+                          steps, impulse_times, impulse_vecs)
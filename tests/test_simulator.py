@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from main import (EXP_A_IMPULSES, EXP_A_STEPS, EXP_B_IMPULSES, EXP_B_STEPS,
+                  EXP_C_IMPULSES, EXP_C_STEPS)
+from src.simulator import Simulator, simulate
+
+EXPERIMENTS = {
+    'bounce': (EXP_A_STEPS, EXP_A_IMPULSES),
+    'slide': (EXP_B_STEPS, EXP_B_IMPULSES),
+    'combined': (EXP_C_STEPS, EXP_C_IMPULSES),
+}
+
+
+@pytest.mark.parametrize('experiment', EXPERIMENTS)
+@pytest.mark.parametrize('friction', [0.1, 0.3, 0.7, 1.0])
+@pytest.mark.parametrize('elasticity', [0.1, 0.5, 1.0])
+@pytest.mark.parametrize('mass', [5.0, 12.0, 25.0])
+def test_compiled_surrogate_matches_pymunk(experiment, friction, elasticity, mass):
+    """The compiled kernel must reproduce the Pymunk reference trajectory."""
+    steps, impulses = EXPERIMENTS[experiment]
+    params = {'friction': friction, 'elasticity': elasticity, 'mass': mass}
+
+    expected = Simulator(params).run_pymunk_trajectory(steps, impulses)
+    actual = simulate(params, steps, impulses)
+
+    np.testing.assert_allclose(actual, expected, rtol=0, atol=1e-4)